@@ -1,14 +1,17 @@
 import os
 import json
-from typing import Optional, List, Dict
+import asyncio
+from typing import TYPE_CHECKING, Optional, List, Dict, Iterator
 
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, JSONResponse
+from fastapi.responses import ORJSONResponse
+from fastapi.staticfiles import StaticFiles
 
-from .pipeline import UHIPipeline, PipelineConfig
+if TYPE_CHECKING:
+    from .pipeline import UHIPipeline
 
-app = FastAPI(title="UHI Analyzer", version="1.0")
+app = FastAPI(title="UHI Analyzer", version="1.0", default_response_class=ORJSONResponse)
 
 # CORS for local dev frontends
 app.add_middleware(
@@ -22,7 +25,51 @@ app.add_middleware(
 OUTPUT_BASE = os.path.abspath(os.getenv("UHI_OUTPUT_DIR", "/workspace/output"))
 os.makedirs(OUTPUT_BASE, exist_ok=True)
 
-pipeline: Optional[UHIPipeline] = None
+pipeline_task: Optional["asyncio.Task[UHIPipeline]"] = None
+# Serializes (re)starting the init task so concurrent /analyze calls never build two pipelines
+pipeline_lock = asyncio.Lock()
+
+# Outputs are overwritten in place on force reruns, so browsers must revalidate (cheap 304 via ETag)
+FILE_CACHE_CONTROL = "no-cache"
+
+
+class CachedStaticFiles(StaticFiles):
+    # StaticFiles already sends ETag/Last-Modified and answers If-None-Match with 304;
+    # only Cache-Control is added, on the /file responses themselves
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        response.headers.setdefault("Cache-Control", FILE_CACHE_CONTROL)
+        return response
+
+
+def _build_pipeline() -> "UHIPipeline":
+    # Heavy imports (ee, numpy, numba, ...) are deferred to here, off the import path
+    from .pipeline import UHIPipeline
+    return UHIPipeline(output_dir=OUTPUT_BASE)
+
+
+def _init_failed(task: "asyncio.Task[UHIPipeline]") -> bool:
+    return task.done() and (task.cancelled() or task.exception() is not None)
+
+
+@app.on_event("startup")
+async def init_pipeline() -> None:
+    # Initialize Earth Engine in the background at boot, so /health, /assets and /file
+    # answer immediately; /analyze waits for it (and reports auth problems)
+    global pipeline_task
+    async with pipeline_lock:
+        pipeline_task = asyncio.create_task(asyncio.to_thread(_build_pipeline))
+
+
+async def _get_pipeline() -> "UHIPipeline":
+    # A failed init (e.g. missing EE auth) is retried on the next /analyze, so running
+    # ee.Authenticate() fixes it without restarting the server
+    global pipeline_task
+    async with pipeline_lock:
+        if pipeline_task is None or _init_failed(pipeline_task):
+            pipeline_task = asyncio.create_task(asyncio.to_thread(_build_pipeline))
+        task = pipeline_task
+    return await task
 
 
 @app.get("/health")
@@ -31,43 +78,56 @@ def health() -> Dict[str, str]:
 
 
 @app.post("/analyze")
-def analyze_city(
+async def analyze_city(
     city: str,
     year: int = Query(2023, ge=2001, le=2025),
     country: Optional[str] = None,
     force: bool = False,
-) -> JSONResponse:
-    global pipeline
+    export_raw: bool = False,
+) -> ORJSONResponse:
+    try:
+        pipeline = await _get_pipeline()
+    except Exception as exc:
+        raise HTTPException(status_code=503, detail=str(exc))
+    from .pipeline import PipelineConfig
     try:
-        if pipeline is None:
-            pipeline = UHIPipeline(output_dir=OUTPUT_BASE)
-        config = PipelineConfig(year=year, city=city, country=country)
-        result = pipeline.run(config=config, force=force)
-        return JSONResponse(content=result)
+        config = PipelineConfig(year=year, city=city, country=country, export_raw=export_raw)
+        # Long-running EE job runs in a worker thread so other endpoints stay responsive
+        result = await asyncio.to_thread(pipeline.run, config, force)
+        return ORJSONResponse(content=result)
     except Exception as exc:
         raise HTTPException(status_code=500, detail=str(exc))
 
 
+ASSET_EXTENSIONS = (".png", ".webp", ".tif", ".json", ".geojson")
+
+
+def _iter_assets(root: str) -> Iterator[os.DirEntry]:
+    # scandir reuses the d_type from readdir, so no per-entry stat calls
+    with os.scandir(root) as it:
+        for entry in it:
+            # Skip hidden entries: the .cache/ stage dir and in-flight .tmp-* writes
+            if entry.name.startswith("."):
+                continue
+            if entry.is_file(follow_symlinks=False):
+                if entry.name.lower().endswith(ASSET_EXTENSIONS):
+                    yield entry
+            elif entry.is_dir(follow_symlinks=False):
+                yield from _iter_assets(entry.path)
+
+
 @app.get("/assets")
-def list_assets(city: str, year: int = 2023) -> JSONResponse:
+def list_assets(city: str, year: int = 2023) -> ORJSONResponse:
     safe_city = city.lower().replace(" ", "_")
     asset_dir = os.path.join(OUTPUT_BASE, safe_city, str(year))
     if not os.path.isdir(asset_dir):
         raise HTTPException(status_code=404, detail="Assets not found. Run /analyze first.")
-    assets = {}
-    for root, _, files in os.walk(asset_dir):
-        for f in files:
-            if f.lower().endswith((".png", ".json", ".geojson")):
-                rel = os.path.relpath(os.path.join(root, f), OUTPUT_BASE)
-                assets[f] = f"/file/{rel}"
-    return JSONResponse(content={"assets": assets})
-
-
-@app.get("/file/{path:path}")
-def get_file(path: str):
-    abs_path = os.path.abspath(os.path.join(OUTPUT_BASE, path))
-    if not abs_path.startswith(OUTPUT_BASE):
-        raise HTTPException(status_code=403, detail="Forbidden path")
-    if not os.path.isfile(abs_path):
-        raise HTTPException(status_code=404, detail="File not found")
-    return FileResponse(abs_path)
\ No newline at end of file
+    assets = {
+        entry.name: f"/file/{os.path.relpath(entry.path, OUTPUT_BASE)}"
+        for entry in _iter_assets(asset_dir)
+    }
+    return ORJSONResponse(content={"assets": assets})
+
+
+# Outputs served by Starlette's static handler (path traversal outside OUTPUT_BASE is rejected)
+app.mount("/file", CachedStaticFiles(directory=OUTPUT_BASE), name="file")
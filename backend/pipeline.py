@@ -1,12 +1,17 @@
 import os
 import io
-import json
+import asyncio
+import tempfile
 import math
 import time
 from dataclasses import dataclass
-from typing import Dict, Any, List, Optional, Tuple
+from typing import Callable, Dict, Any, List, Optional, Tuple, Union
 
+import aiofiles
+import aiohttp
 import numpy as np
+import orjson
+from PIL import Image
 
 # Import Earth Engine lazily to allow helpful error messages on auth
 try:
@@ -16,7 +21,8 @@ except Exception as _e:
 
 from .stats import run_spatial_stats
 from .providers import (
-    geocode_city_boundary,
+    fetch_city_place,
+    place_to_geometry,
     load_lst,
     load_ndvi,
     load_lulc,
@@ -31,17 +37,82 @@ from .providers import (
 )
 
 
+# High-volume endpoint is recommended for many small automated requests (thumbnails)
+EE_HIGH_VOLUME_URL = 'https://earthengine-highvolume.googleapis.com'
+# Stay well below the high-volume endpoint's concurrent request quota
+THUMB_CONCURRENCY = 20
+# Split server-side aggregations into smaller tiles up front to avoid EE out-of-memory retries
+EE_TILE_SCALE = 4
+
+# thresholds.json key -> output of the combined percentile/mean reduction
+THRESHOLD_KEYS = {
+    'lst80': 'lst_p80',
+    'ndvi20': 'ndvi_p20',
+    'ntl80': 'ntl_p80',
+    'albedo20': 'albedo_p20',
+    'imperv80': 'impervious_p80',
+    'bld80': 'bld_dens_p80',
+    'pop80': 'pop_p80',
+    'elev_mean': 'elev_mean',
+}
+
+# Categorical / mask thumbnails: lossy WebP would smear class colours and mask edges
+LOSSLESS_THUMBS = frozenset({
+    'lulc.webp', 'threshold_exceedance.webp', 'preliminary_hotspots.webp', 'validated_hotspots.webp'
+})
+
+# GeoTIFFs written when PipelineConfig.export_raw is set
+RAW_ASSETS = ('count_true.tif', 'preliminary_hotspots.tif')
+
+
 @dataclass
 class PipelineConfig:
     year: int
     city: str
     country: Optional[str] = None
+    # Also write raw count_true / prelim_hot GeoTIFFs via computePixels
+    export_raw: bool = False
 
 
 def _safe_slug(text: str) -> str:
     return text.lower().replace(" ", "_")
 
 
+def _to_webp(png_bytes: bytes, lossless: bool = False) -> bytes:
+    # EE thumbnails only render PNG/JPEG; re-encode to WebP (keeps alpha for masks)
+    with Image.open(io.BytesIO(png_bytes)) as img:
+        buf = io.BytesIO()
+        if lossless:
+            img.save(buf, format='WEBP', lossless=True, method=4)
+        else:
+            img.save(buf, format='WEBP', quality=90, method=4)
+    return buf.getvalue()
+
+
+async def _download_all(
+    jobs: List[Tuple[str, str]], concurrency: int = THUMB_CONCURRENCY
+) -> List[Union[str, BaseException]]:
+    # Fetch all (url, out_path) pairs concurrently; .webp targets are re-encoded off the event loop.
+    # Failures are returned in place of the path so the caller decides which ones are fatal
+    sem = asyncio.Semaphore(concurrency)
+    timeout = aiohttp.ClientTimeout(total=300)
+
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async def fetch(url: str, out_path: str) -> str:
+            async with sem:
+                async with session.get(url) as resp:
+                    resp.raise_for_status()
+                    body = await resp.read()
+            if out_path.lower().endswith('.webp'):
+                lossless = os.path.basename(out_path) in LOSSLESS_THUMBS
+                body = await asyncio.to_thread(_to_webp, body, lossless)
+            async with aiofiles.open(out_path, 'wb') as f:
+                await f.write(body)
+            return out_path
+
+        return await asyncio.gather(*(fetch(url, out_path) for url, out_path in jobs), return_exceptions=True)
+
+
 class UHIPipeline:
     def __init__(self, output_dir: str):
         self.output_dir = os.path.abspath(output_dir)
@@ -54,10 +125,10 @@ class UHIPipeline:
             raise RuntimeError("earthengine-api is not installed. Please install requirements.")
         try:
             # Try project-specific init as requested
-            ee.Initialize(project='mod11a2')
+            ee.Initialize(project='mod11a2', opt_url=EE_HIGH_VOLUME_URL)
         except Exception:
             try:
-                ee.Initialize()
+                ee.Initialize(opt_url=EE_HIGH_VOLUME_URL)
             except Exception as exc:
                 # Provide a helpful message for first-time auth
                 raise RuntimeError(
@@ -73,11 +144,30 @@ class UHIPipeline:
         return city_dir
 
     def _save_json(self, path: str, data: Dict[str, Any]) -> str:
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        # orjson writes UTF-8 directly and serializes NumPy arrays without .tolist()
+        payload = orjson.dumps(data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+        # Write to a temp file and swap it in, so a crash never leaves a truncated JSON behind
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-', suffix='.json')
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
         return path
 
-    def _thumb(self, image: 'ee.Image', region: 'ee.Geometry', vis: Dict[str, Any], out_path: str, dimensions: int = 2048) -> str:
+    def _cached_json(self, path: str, fn: Callable[[], Any], refresh: bool = False) -> Any:
+        # Reuse a stage result from disk if present (unless refresh), otherwise compute and persist it
+        if os.path.isfile(path) and not refresh:
+            with open(path, 'rb') as f:
+                return orjson.loads(f.read())
+        data = fn()
+        self._save_json(path, data)
+        return data
+
+    def _thumb(self, image: 'ee.Image', region: 'ee.Geometry', vis: Dict[str, Any], dimensions: int = 2048) -> str:
         params = {
             'region': region,
             'dimensions': dimensions
@@ -88,19 +178,40 @@ class UHIPipeline:
             params['max'] = vis.get('max')
         if 'palette' in vis:
             params['palette'] = vis.get('palette')
-        url = image.getThumbURL(params)
-        # Download
-        import requests
-        r = requests.get(url, timeout=300)
-        r.raise_for_status()
+        # Only build the URL; downloads are batched in run()
+        return image.getThumbURL(params)
+
+    def _export_geotiff(self, image: 'ee.Image', bbox: List[float], out_path: str, max_dim: int = 2048) -> str:
+        # Raw pixels via computePixels on a north-up EPSG:4326 grid over bbox [west, south, east, north]
+        west, south, east, north = bbox
+        span_x, span_y = east - west, north - south
+        if span_x >= span_y:
+            width, height = max_dim, max(1, round(max_dim * span_y / span_x))
+        else:
+            width, height = max(1, round(max_dim * span_x / span_y)), max_dim
+        data = ee.data.computePixels({
+            'expression': image,
+            'fileFormat': 'GEO_TIFF',
+            'grid': {
+                'dimensions': {'width': width, 'height': height},
+                'affineTransform': {
+                    'scaleX': span_x / width,
+                    'shearX': 0,
+                    'translateX': west,
+                    'shearY': 0,
+                    'scaleY': -span_y / height,
+                    'translateY': north
+                },
+                'crsCode': 'EPSG:4326'
+            }
+        })
         with open(out_path, 'wb') as f:
-            f.write(r.content)
+            f.write(data)
         return out_path
 
-    def _boolean_count(self, images: List['ee.Image']) -> 'ee.Image':
-        stack = ee.ImageCollection(images).toBands()
+    def _boolean_count(self, image: 'ee.Image') -> 'ee.Image':
         # Reduce along bands: count of non-zero
-        return stack.gt(0).reduce(ee.Reducer.sum()).rename('count_true')
+        return image.gt(0).reduce(ee.Reducer.sum()).rename('count_true')
 
     def run(self, config: PipelineConfig, force: bool = False) -> Dict[str, Any]:
         city = config.city
@@ -108,11 +219,23 @@ class UHIPipeline:
         city_dir = self._city_output_dir(city, year)
         index_path = os.path.join(city_dir, 'index.json')
         if os.path.isfile(index_path) and not force:
-            with open(index_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            with open(index_path, 'rb') as f:
+                index = orjson.loads(f.read())
+            # A cached run without the raw rasters does not satisfy export_raw; rerun from the stage caches
+            if not config.export_raw or all(name in index.get('assets', {}) for name in RAW_ASSETS):
+                return index
+
+        # Stage caches are keyed by country as well, since it changes the geocoded AOI;
+        # force recomputes and overwrites them
+        country_slug = _safe_slug(config.country or 'auto')
+        # Private stage caches live under .cache/, which /assets does not list
+        cache_dir = os.path.join(city_dir, '.cache')
+        os.makedirs(cache_dir, exist_ok=True)
 
-        # 1) Boundary
-        aoi = geocode_city_boundary(city, config.country)
+        # 1) Boundary (geocoding cached per city/country)
+        boundary_path = os.path.join(cache_dir, f"boundary_{country_slug}.json")
+        place = self._cached_json(boundary_path, lambda: fetch_city_place(city, config.country), refresh=force)
+        aoi = place_to_geometry(place)
 
         # 2) Load variables
         lst = load_lst(year, aoi).rename('lst')
@@ -126,107 +249,124 @@ class UHIPipeline:
         water_distance = load_water_distance(aoi).rename('water_dist')
         elevation = load_elevation(aoi).rename('elev')
 
-        # 3) Thresholds (percentiles per AOI)
-        def pctl(img: 'ee.Image', pct: float, scale: int) -> float:
-            val = img.reduceRegion(ee.Reducer.percentile([pct]), aoi, scale=scale, maxPixels=1e9)
-            # take first value
-            return ee.Number(val.values().get(0))
+        # Single multiband stack reused by reductions, sampling and visualization so EE
+        # shares the upstream graph instead of rebuilding it per product
+        stack = ee.Image.cat([
+            lst, ndvi, albedo, impervious, building_density, population, ntl, water_distance, elevation, lulc
+        ]).clip(aoi)
+
+        # 3) Thresholds (percentiles per AOI) + elevation mean in a single reduction / round-trip
+        def compute_thresholds() -> Dict[str, float]:
+            thresh_stack = stack.select(['lst', 'ndvi', 'albedo', 'impervious', 'bld_dens', 'pop', 'ntl', 'elev'])
+            # One input per reducer so it is repeated per band -> keys like 'lst_p80', 'elev_mean'
+            thresh_reducer = ee.Reducer.percentile([20, 80]).combine(ee.Reducer.mean(), sharedInputs=True)
+            reduced = thresh_stack.reduceRegion(
+                thresh_reducer, aoi, scale=300, maxPixels=1e9, bestEffort=True, tileScale=EE_TILE_SCALE
+            )
+            # Pick the named thresholds server-side and fetch them in one ee.Dictionary round-trip
+            thresh_dict = ee.Dictionary({k: reduced.get(v) for k, v in THRESHOLD_KEYS.items()}).getInfo()
+            return {k: float(v) for k, v in thresh_dict.items()}
 
-        lst80 = pctl(lst, 80, 1000)
-        ndvi20 = pctl(ndvi, 20, 300)
-        ntl80 = pctl(ntl, 80, 500)
-        albedo20 = pctl(albedo, 20, 500)
-        imperv80 = pctl(impervious, 80, 100)
-        bld80 = pctl(building_density, 80, 300)
-        pop80 = pctl(population, 80, 300)
+        thresholds = self._cached_json(
+            os.path.join(cache_dir, f"thresholds_{country_slug}.json"), compute_thresholds, refresh=force
+        )
+
+        lst80 = ee.Number(thresholds['lst80'])
+        ndvi20 = ee.Number(thresholds['ndvi20'])
+        ntl80 = ee.Number(thresholds['ntl80'])
+        albedo20 = ee.Number(thresholds['albedo20'])
+        imperv80 = ee.Number(thresholds['imperv80'])
+        bld80 = ee.Number(thresholds['bld80'])
+        pop80 = ee.Number(thresholds['pop80'])
 
         # 4) Mandatory masks
-        urban_mask = lulc.eq(13)
-        elev_mean = elevation.reduceRegion(ee.Reducer.mean(), aoi, scale=90, maxPixels=1e9).get('elev')
-        elev_ok = elevation.lte(ee.Number(elev_mean).add(200))
+        urban_mask = stack.select('lulc').eq(13)
+        elev_ok = stack.select('elev').lte(ee.Number(thresholds['elev_mean']).add(200))
 
         # 5) Boolean exceedances (8 vars)
         conds = [
-            lst.gt(lst80).rename('c_lst'),
-            ndvi.lt(ndvi20).rename('c_ndvi'),
-            albedo.lt(albedo20).rename('c_albedo'),
-            impervious.gt(imperv80).rename('c_imperv'),
-            building_density.gt(bld80).rename('c_bld'),
-            population.gt(pop80).rename('c_pop'),
-            ntl.gt(ntl80).rename('c_ntl'),
-            water_distance.gt(500).rename('c_waterdist')
+            stack.select('lst').gt(lst80).rename('c_lst'),
+            stack.select('ndvi').lt(ndvi20).rename('c_ndvi'),
+            stack.select('albedo').lt(albedo20).rename('c_albedo'),
+            stack.select('impervious').gt(imperv80).rename('c_imperv'),
+            stack.select('bld_dens').gt(bld80).rename('c_bld'),
+            stack.select('pop').gt(pop80).rename('c_pop'),
+            stack.select('ntl').gt(ntl80).rename('c_ntl'),
+            stack.select('water_dist').gt(500).rename('c_waterdist')
         ]
 
-        count_true = self._boolean_count(conds)
-        prelim_hot = count_true.gte(6).And(urban_mask).And(elev_ok).selfMask().rename('prelim_hot')
+        # Exceedance bands, their count and the preliminary hotspots live on the same stack
+        stack = stack.addBands(ee.Image.cat(conds))
+        stack = stack.addBands(self._boolean_count(stack.select('c_.*')))
+        count_true = stack.select('count_true')
+        stack = stack.addBands(count_true.gte(6).And(urban_mask).And(elev_ok).selfMask().rename('prelim_hot'))
+        prelim_hot = stack.select('prelim_hot')
 
         # 6) Sampling for spatial stats
         # Sample 1500 points within AOI at 300m scale
-        sample_img = count_true
-        samples = sample_img.addBands([lst, ndvi, ntl]).sample(
-            region=aoi, scale=300, numPixels=1500, geometries=True, seed=42
+        samples = stack.select(['count_true', 'lst', 'ndvi', 'ntl']).sample(
+            region=aoi, scale=300, numPixels=1500, geometries=True, seed=42, tileScale=EE_TILE_SCALE
         )
-        # Export samples to client for stats
-        # Get lists
-        coords = samples.map(lambda f: f.set({'lon': f.geometry().coordinates().get(0), 'lat': f.geometry().coordinates().get(1)}))
-        fc = coords.getInfo()
-        values = []
-        lons = []
-        lats = []
-        for feat in fc['features']:
-            props = feat['properties']
-            if 'count_true' in props and props['count_true'] is not None:
-                values.append(props['count_true'])
-                lons.append(props['lon'])
-                lats.append(props['lat'])
-        stats = run_spatial_stats(values=np.array(values), lons=np.array(lons), lats=np.array(lats))
+        # Export samples to client for stats: property rows + point geometry in one reduceColumns
+        sample_columns = ['count_true', 'lst', 'ndvi', 'ntl']
+        selectors = sample_columns + ['.geo']
+        samples_path = os.path.join(cache_dir, f"samples_{country_slug}.json")
+        sample_data = self._cached_json(samples_path, lambda: {
+            'columns': selectors,
+            'rows': samples.reduceColumns(ee.Reducer.toList(len(selectors)), selectors).get('list').getInfo()
+        }, refresh=force)
+        rows = sample_data['rows']
+        # Point coordinates come straight from the GeoJSON geometry of each row
+        coords = np.asarray([row[-1]['coordinates'] for row in rows], dtype=np.float64).reshape(-1, 2)
+        values = np.asarray([row[0] for row in rows], dtype=np.float64)
+        lons, lats = coords[:, 0], coords[:, 1]
+        # From here on only the three aligned arrays are kept (no per-row Python objects)
+        del sample_data, rows, coords
+        valid = ~np.isnan(values)
+        values, lons, lats = values[valid], lons[valid], lats[valid]
+        stats = run_spatial_stats(values=values, lons=lons, lats=lats)
 
         # 7) Visual products
         vis = get_vis_params()
         assets: Dict[str, str] = {}
+        downloads: List[Tuple[str, str]] = []
+        # out_path -> asset name for products that are skipped (not fatal) if they fail
+        optional_downloads: Dict[str, str] = {}
 
-        # Save raw thresholds
+        # Save raw thresholds (public copy of the cached stage)
         thresholds_path = os.path.join(city_dir, 'thresholds.json')
-        self._save_json(thresholds_path, {
-            'lst80': float(lst80.getInfo()),
-            'ndvi20': float(ndvi20.getInfo()),
-            'ntl80': float(ntl80.getInfo()),
-            'albedo20': float(albedo20.getInfo()),
-            'imperv80': float(imperv80.getInfo()),
-            'bld80': float(bld80.getInfo()),
-            'pop80': float(pop80.getInfo())
-        })
+        self._save_json(thresholds_path, thresholds)
         assets['thresholds.json'] = thresholds_path
 
         # Thumbnails for variables
         var_imgs = {
-            'lst.png': lst.visualize(**vis['lst']),
-            'ndvi.png': ndvi.visualize(**vis['ndvi']),
-            'albedo.png': albedo.visualize(**vis['albedo']),
-            'impervious.png': impervious.visualize(**vis['impervious']),
-            'building_density.png': building_density.visualize(**vis['bld']),
-            'population.png': population.visualize(**vis['pop']),
-            'ntl.png': ntl.visualize(**vis['ntl']),
-            'water_distance.png': water_distance.visualize(**vis['waterdist']),
-            'elevation.png': elevation.visualize(**vis['elev']),
-            'lulc.png': lulc.visualize(**vis['lulc'])
+            'lst.webp': stack.select('lst').visualize(**vis['lst']),
+            'ndvi.webp': stack.select('ndvi').visualize(**vis['ndvi']),
+            'albedo.webp': stack.select('albedo').visualize(**vis['albedo']),
+            'impervious.webp': stack.select('impervious').visualize(**vis['impervious']),
+            'building_density.webp': stack.select('bld_dens').visualize(**vis['bld']),
+            'population.webp': stack.select('pop').visualize(**vis['pop']),
+            'ntl.webp': stack.select('ntl').visualize(**vis['ntl']),
+            'water_distance.webp': stack.select('water_dist').visualize(**vis['waterdist']),
+            'elevation.webp': stack.select('elev').visualize(**vis['elev']),
+            'lulc.webp': stack.select('lulc').visualize(**vis['lulc'])
         }
         for name, vimg in var_imgs.items():
             out = os.path.join(city_dir, name)
-            self._thumb(vimg, aoi, vis={'min': 0, 'max': 1}, out_path=out)
+            downloads.append((self._thumb(vimg, aoi, vis={'min': 0, 'max': 1}), out))
             assets[name] = out
 
         # Count-exceedance map
         count_vis = count_true.visualize(**vis['count'])
-        count_path = os.path.join(city_dir, 'threshold_exceedance.png')
-        self._thumb(count_vis, aoi, vis={}, out_path=count_path)
-        assets['threshold_exceedance.png'] = count_path
+        count_path = os.path.join(city_dir, 'threshold_exceedance.webp')
+        downloads.append((self._thumb(count_vis, aoi, vis={}), count_path))
+        assets['threshold_exceedance.webp'] = count_path
 
         # Preliminary hotspot
         prelim_vis = prelim_hot.visualize(**vis['hot'])
-        prelim_path = os.path.join(city_dir, 'preliminary_hotspots.png')
-        self._thumb(prelim_vis, aoi, vis={}, out_path=prelim_path)
-        assets['preliminary_hotspots.png'] = prelim_path
+        prelim_path = os.path.join(city_dir, 'preliminary_hotspots.webp')
+        downloads.append((self._thumb(prelim_vis, aoi, vis={}), prelim_path))
+        assets['preliminary_hotspots.webp'] = prelim_path
 
         # Build consensus validated hotspots: Gi* hotspot (95%) AND Moran significant (95%) with HH quadrant
         try:
@@ -234,32 +374,44 @@ class UHIPipeline:
             mi_sig = np.array(stats.get('moran', {}).get('significant_95_mask', []), dtype=int)
             mi_q = np.array(stats.get('moran', {}).get('q', []), dtype=int)
             sig_both = (gi_hot == 1) & (mi_sig == 1) & (mi_q == 1)
-            # Rebuild point FeatureCollection with sig_both
-            features = []
-            idx = 0
-            for feat in fc['features']:
-                props = feat['properties']
-                if 'count_true' in props and props['count_true'] is not None:
-                    if idx < sig_both.size and sig_both[idx]:
-                        lon = props['lon']
-                        lat = props['lat']
-                        point = ee.Geometry.Point([lon, lat])
-                        features.append(ee.Feature(point, {'sig': 1}))
-                    idx += 1
-            sig_fc = ee.FeatureCollection(features)
-            sig_img = sig_fc.reduceToImage(['sig'], ee.Reducer.sum()).rename('sig')
-            # Buffer influence using 500 m kernel, then threshold > 0
-            kernel = ee.Kernel.circle(radius=500, units='meters')
-            sig_density = sig_img.focal_max(kernel=kernel)
-            validated_hot = prelim_hot.And(sig_density.gt(0)).selfMask().rename('validated_hot')
+            if not sig_both.any():
+                # No consensus points: render an empty (fully masked) map rather than buffering nothing
+                validated_hot = prelim_hot.updateMask(ee.Image(0)).rename('validated_hot')
+            else:
+                # Significant points buffered by 500 m, used directly as a clip region
+                sig_points = ee.Geometry.MultiPoint(np.column_stack([lons[sig_both], lats[sig_both]]).tolist())
+                sig_region = sig_points.buffer(500)
+                validated_hot = prelim_hot.clip(sig_region).selfMask().rename('validated_hot')
             val_vis = validated_hot.visualize(**vis['hot'])
-            val_path = os.path.join(city_dir, 'validated_hotspots.png')
-            self._thumb(val_vis, aoi, vis={}, out_path=val_path)
-            assets['validated_hotspots.png'] = val_path
+            val_path = os.path.join(city_dir, 'validated_hotspots.webp')
+            downloads.append((self._thumb(val_vis, aoi, vis={}), val_path))
+            assets['validated_hotspots.webp'] = val_path
+            optional_downloads[val_path] = 'validated_hotspots.webp'
         except Exception:
             # If anything fails, skip validated map
             pass
 
+        # Download all thumbnails concurrently
+        results = asyncio.run(_download_all(downloads))
+        for (_, out_path), result in zip(downloads, results):
+            if isinstance(result, BaseException):
+                if out_path not in optional_downloads:
+                    raise result
+                # If the validated map fails to download, skip it as before
+                assets.pop(optional_downloads[out_path], None)
+
+        # Optional raw numeric rasters for downstream analyses
+        if config.export_raw:
+            south, north, west, east = (float(v) for v in place['boundingbox'])
+            bbox = [west, south, east, north]
+            raw_imgs = {
+                # 255 = nodata (outside the AOI), so it never collides with a real count of 0
+                'count_true.tif': count_true.unmask(255).toUint8(),
+                'preliminary_hotspots.tif': prelim_hot.unmask(0).toUint8(),
+            }
+            for name, rimg in raw_imgs.items():
+                assets[name] = self._export_geotiff(rimg, bbox, os.path.join(city_dir, name))
+
         # Save stats JSON
         stats_path = os.path.join(city_dir, 'spatial_stats.json')
         self._save_json(stats_path, stats)
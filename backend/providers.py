@@ -3,6 +3,8 @@ from typing import Dict, Any, Optional
 
 import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 try:
     import ee  # type: ignore
@@ -10,26 +12,43 @@ except Exception:
     ee = None
 
 
-def geocode_city_boundary(city: str, country: Optional[str] = None) -> 'ee.Geometry':
-    # Use Nominatim to fetch city polygon or bbox
+# Shared pooled session; retries back off on rate limiting (429) and transient 5xx
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+
+def fetch_city_place(city: str, country: Optional[str] = None) -> Dict[str, Any]:
+    # Use Nominatim to fetch city polygon or bbox (plain JSON, safe to cache)
     q = f"{city}, {country}" if country else city
     url = "https://nominatim.openstreetmap.org/search"
     params = {"q": q, "format": "json", "polygon_geojson": 1, "limit": 1}
-    resp = requests.get(url, params=params, headers={"User-Agent": "uhi-analyzer/1.0"}, timeout=60)
+    resp = _SESSION.get(url, params=params, headers={"User-Agent": "uhi-analyzer/1.0"}, timeout=60)
     resp.raise_for_status()
     data = resp.json()
     if not data:
         raise ValueError(f"Could not geocode city: {q}")
     item = data[0]
-    if 'geojson' in item and item['geojson']:
-        geom = ee.Geometry(item['geojson'])
+    return {'geojson': item.get('geojson'), 'boundingbox': item.get('boundingbox')}
+
+
+def place_to_geometry(place: Dict[str, Any]) -> 'ee.Geometry':
+    if place.get('geojson'):
+        geom = ee.Geometry(place['geojson'])
     else:
         # Fallback to bbox
-        bbox = [float(item['boundingbox'][2]), float(item['boundingbox'][0]), float(item['boundingbox'][3]), float(item['boundingbox'][1])]
+        bbox = [float(place['boundingbox'][2]), float(place['boundingbox'][0]), float(place['boundingbox'][3]), float(place['boundingbox'][1])]
         geom = ee.Geometry.Rectangle(bbox)
     return geom.simplify(100)
 
 
+def geocode_city_boundary(city: str, country: Optional[str] = None) -> 'ee.Geometry':
+    return place_to_geometry(fetch_city_place(city, country))
+
+
 # Loaders
 
 def load_lst(year: int, aoi: 'ee.Geometry') -> 'ee.Image':
@@ -1,46 +1,181 @@
+import math
 from typing import Dict
 import numpy as np
+from numba import njit, prange
 
-from esda.getisord import G_Local
-from esda.moran import Moran_Local
-from libpysal.weights import KNN
+# fastmath without 'nnan'/'ninf' so the NaN checks below are not optimized away
+_FASTMATH = {'nsz', 'arcp', 'contract', 'afn', 'reassoc'}
 
+# Conditional permutations for Local Moran's I pseudo p-values (esda default)
+PERMUTATIONS = 999
 
-def run_spatial_stats(values: np.ndarray, lons: np.ndarray, lats: np.ndarray) -> Dict:
-    # Remove NaNs
-    mask = ~np.isnan(values)
-    values = values[mask]
-    lons = lons[mask]
-    lats = lats[mask]
-    if values.size < 50:
-        return {"error": "Insufficient samples for spatial statistics"}
 
-    coords = np.column_stack([lons, lats])
+@njit(cache=True, fastmath=_FASTMATH)
+def _prep(values: np.ndarray, lons: np.ndarray, lats: np.ndarray):
+    # Drop NaNs, build coords and standardize in fused loops (no masked temporaries)
+    n = values.size
+    count = 0
+    total = 0.0
+    for i in range(n):
+        v = values[i]
+        if not np.isnan(v):
+            total += v
+            count += 1
+    x = np.empty(count, dtype=np.float64)
+    coords = np.empty((count, 2), dtype=np.float64)
+    if count == 0:
+        return x, coords
+    mean = total / count
+    ss = 0.0
+    j = 0
+    for i in range(n):
+        v = values[i]
+        if not np.isnan(v):
+            d = v - mean
+            ss += d * d
+            x[j] = d
+            coords[j, 0] = lons[i]
+            coords[j, 1] = lats[i]
+            j += 1
+    inv_std = 1.0 / (np.sqrt(ss / count) + 1e-9)
+    for j in range(count):
+        x[j] *= inv_std
+    return x, coords
+
+
+@njit(cache=True)
+def _hot_masks(zs: np.ndarray, pnorm: np.ndarray, psim: np.ndarray):
+    # Gi* hotspot (z > 1.96, p < 0.05) and Moran significance (p_sim < 0.05) in one pass
+    n = zs.size
+    gi_hot = np.empty(n, dtype=np.int8)
+    mi_sig = np.empty(n, dtype=np.int8)
+    for i in range(n):
+        gi_hot[i] = 1 if (zs[i] > 1.96 and pnorm[i] < 0.05) else 0
+        mi_sig[i] = 1 if psim[i] < 0.05 else 0
+    return gi_hot, mi_sig
+
+
+def _knn_indices(coords: np.ndarray, k: int = 8) -> np.ndarray:
+    # (n, k) neighbour index matrix from a parallel cKDTree query (self excluded)
+    from scipy.spatial import cKDTree  # deferred: only needed once stats actually run
+
+    n = coords.shape[0]
+    _, idx = cKDTree(coords).query(coords, k=k + 1, workers=-1)
+    self_col = idx == np.arange(n)[:, None]
+    # With duplicate coordinates self may not be returned; drop the farthest instead
+    self_col[~self_col.any(axis=1), -1] = True
+    # Sorted rows sum neighbours in the same order as a CSR row product (exact ties at 0 agree)
+    return np.ascontiguousarray(np.sort(idx[~self_col].reshape(n, k), axis=1), dtype=np.int64)
+
+
+# error_model='numpy': degenerate input (zero sum / zero variance) yields inf/NaN like esda
+# instead of raising ZeroDivisionError
+@njit(cache=True, parallel=True, error_model='numpy')
+def _local_stats(x: np.ndarray, z: np.ndarray, scaling: float, total: float, sum_sq: float,
+                 idx: np.ndarray, permutations: int):
+    # Local Moran's I and Getis-Ord Gi* for row-standardized kNN weights, matching
+    # esda.Moran_Local(x, w) and esda.G_Local(x, w, star=True) (self-weight = neighbour weight).
+    # z, scaling, total and sum_sq are the global terms precomputed by the caller.
+    n, k = idx.shape
+
+    # Gi* analytical moments (cardinality 1 after row-standardization, N = n)
+    g_mean = total / n
+    g_var = sum_sq / n - g_mean * g_mean
+    g_sd = np.sqrt(g_var / (g_mean * g_mean)) / n
+
+    Is = np.empty(n, dtype=np.float64)
+    p_sim = np.empty(n, dtype=np.float64)
+    q = np.empty(n, dtype=np.int64)
+    Zs = np.empty(n, dtype=np.float64)
+    p_norm = np.empty(n, dtype=np.float64)
 
-    # Standardize values
-    x = (values - values.mean()) / (values.std() + 1e-9)
+    w_ij = 1.0 / k
+
+    for i in prange(n):
+        # Accumulate weighted terms (as the sparse row product does) so ties at 0 match esda
+        z_lag = 0.0
+        x_sum = x[i]
+        for j in range(k):
+            z_lag += z[idx[i, j]] * w_ij
+            x_sum += x[idx[i, j]]
+        Is[i] = scaling * z[i] * z_lag
+
+        # Quadrants: 1 HH, 2 LH, 3 LL, 4 HL
+        if z[i] > 0:
+            q[i] = 1 if z_lag > 0 else 4
+        else:
+            q[i] = 2 if z_lag > 0 else 3
+
+        g = x_sum / (k + 1) / total
+        Zs[i] = (g - 1.0 / n) / g_sd
+        p_norm[i] = 0.5 * math.erfc(abs(Zs[i]) / math.sqrt(2.0))
+
+        # Conditional permutation: k random non-self neighbours per draw
+        draw = np.empty(k, dtype=np.int64)
+        larger = 0
+        for _ in range(permutations):
+            s = 0.0
+            m = 0
+            while m < k:
+                c = np.random.randint(0, n - 1)
+                if c >= i:
+                    c += 1
+                dup = False
+                for t in range(m):
+                    if draw[t] == c:
+                        dup = True
+                        break
+                if not dup:
+                    draw[m] = c
+                    s += z[c]
+                    m += 1
+            if scaling * z[i] * (s / k) >= Is[i]:
+                larger += 1
+        if permutations - larger < larger:
+            larger = permutations - larger
+        p_sim[i] = (larger + 1.0) / (permutations + 1.0)
+
+    return Is, p_sim, q, Zs, p_norm
+
+
+def run_spatial_stats(values: np.ndarray, lons: np.ndarray, lats: np.ndarray) -> Dict:
+    # Remove NaNs and standardize values
+    x, coords = _prep(
+        np.ascontiguousarray(values, dtype=np.float64),
+        np.ascontiguousarray(lons, dtype=np.float64),
+        np.ascontiguousarray(lats, dtype=np.float64),
+    )
+    if x.size < 50:
+        return {"error": "Insufficient samples for spatial statistics"}
 
     # Spatial weights: 8-nearest neighbors
-    w = KNN.from_array(coords, k=8)
-    w.transform = 'R'
+    idx = _knn_indices(coords, k=8)
+
+    # Getis-Ord Gi* and Local Moran's I
+    # Global terms via NumPy's pairwise sums, exactly as esda computes them: x is already
+    # standardized, so sum(x) is ~0 and its rounding decides the sign of the Gi* z-scores
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = (x - x.mean()) / x.std()
+        scaling = (x.size - 1) / (z * z).sum()
+    total = x.sum()
+    sum_sq = (x ** 2).sum()
 
-    # Getis-Ord Gi*
-    gi = G_Local(x, w, star=True)
+    Is, p_sim, q, Zs, p_norm = _local_stats(x, z, scaling, total, sum_sq, idx, PERMUTATIONS)
 
-    # Local Moran's I
-    mi = Moran_Local(x, w)
+    gi_hot, mi_sig = _hot_masks(Zs, p_norm, p_sim)
 
+    # Arrays are returned as-is; the orjson writer serializes them natively
     return {
-        'n': int(values.size),
+        'n': int(x.size),
         'gi': {
-            'z_scores': gi.Zs.tolist(),
-            'p_values': gi.p_norm.tolist(),
-            'hotspot_95_mask': ((gi.Zs > 1.96) & (gi.p_norm < 0.05)).astype(int).tolist()
+            'z_scores': Zs,
+            'p_values': p_norm,
+            'hotspot_95_mask': gi_hot
         },
         'moran': {
-            'Is': mi.Is.tolist(),
-            'p_values': mi.p_sim.tolist(),
-            'significant_95_mask': (mi.p_sim < 0.05).astype(int).tolist(),
-            'q': mi.q.tolist()
+            'Is': Is,
+            'p_values': p_sim,
+            'significant_95_mask': mi_sig,
+            'q': q
         }
-    }
\ No newline at end of file
+    }
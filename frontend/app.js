@@ -40,10 +40,12 @@ form.addEventListener('submit', async (e) => {
 
     const assets = data.assets;
     const ordered = [
-      'lst.png','ndvi.png','albedo.png','impervious.png','building_density.png','population.png','ntl.png','water_distance.png','elevation.png','lulc.png','threshold_exceedance.png','preliminary_hotspots.png','validated_hotspots.png'
+      'lst','ndvi','albedo','impervious','building_density','population','ntl','water_distance','elevation','lulc','threshold_exceedance','preliminary_hotspots','validated_hotspots'
     ];
-    for (const key of ordered) {
-      if (assets[key]) addCard(key.replace('.png','').replace('_',' ').toUpperCase(), assets[key]);
+    for (const name of ordered) {
+      // Results cached before the WebP switch still list .png assets
+      const src = assets[name + '.webp'] || assets[name + '.png'];
+      if (src) addCard(name.replace('_',' ').toUpperCase(), src);
     }
 
     if (assets['spatial_stats.json']) {